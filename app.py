@@ -1,22 +1,29 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_file, flash, jsonify
-from flask_compress import Compress
+from flask import Flask, render_template, request, redirect, url_for, session, send_file, send_from_directory, make_response, flash, jsonify, abort, g
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.utils import secure_filename
-from gym_manager import GymManager
+from gym_manager import GymManager, previous_month
 from auth_manager import AuthManager
+from models import remove_session
 import os
 import json
-from datetime import datetime, timedelta
-import pandas as pd
-from reportlab.lib.pagesizes import letter
-from reportlab.pdfgen import canvas
-from reportlab.lib.utils import ImageReader
+import orjson
+import threading
+import time
+from functools import wraps
+from collections import OrderedDict
+from datetime import date, datetime, timedelta
 from io import BytesIO
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
-import qrcode
+import tempfile
+import hashlib
 import base64
+import uuid
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import BaseTarget, FileTarget, ValueTarget
 from dotenv import load_dotenv
-from google_wallet import GymWalletPass
+from redis_utils import get_redis
+from tasks import get_queue, get_stripe, verify_and_renew, build_bulk_receipts
+from receipts import build_receipt_pdf, build_bulk_receipts_pdf
 
 # Load environment variables from .env file
 load_dotenv()
@@ -29,36 +36,169 @@ try:
 except Exception as e:
     print(f"⚠️ Database init warning: {str(e)}")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (compact, unsorted keys)"""
+    compact = True
+    sort_keys = False
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_INDENT_2 if kwargs.get('indent') else 0
+        return orjson.dumps(obj, default=self.default, option=option).decode('utf-8')
+    
+    @staticmethod
+    def default(o):
+        """Also serialize lightweight row objects such as gym_manager.PaymentRow"""
+        if hasattr(o, 'as_dict'):
+            return o.as_dict()
+        return DefaultJSONProvider.default(o)
+    
+    def loads(self, s, **kwargs):
+        # object_hook etc. (used by the cookie session serializer) need the stdlib path
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
-# Enable compression for all responses
-Compress(app)
+# Server-side sessions in Redis (falls back to signed cookies without REDIS_URL)
+redis_client = get_redis()
+if redis_client is not None:
+    from flask_session import Session
+    app.config.update(
+        SESSION_TYPE='redis',
+        SESSION_REDIS=redis_client,
+        SESSION_USE_SIGNER=True,
+        SESSION_PERMANENT=False
+    )
+    Session(app)
 
 # Configuration
 UPLOAD_FOLDER = 'static/uploads'
+QR_FOLDER = 'static/qrcodes'
+# Outside static/ so Flask's static route can never serve them
+PROOF_FOLDER = 'instance/proofs'
+RECEIPT_CACHE_FOLDER = 'cache/receipts'
+# Cached receipts not downloaded for this long are deleted
+RECEIPT_CACHE_MAX_AGE = 30 * 24 * 3600  # seconds
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+_ALLOWED_SUFFIXES = tuple(f'.{ext}' for ext in ALLOWED_EXTENSIONS)
+# Payment proofs are often phone photos or bank PDFs
+_PROOF_SUFFIXES = _ALLOWED_SUFFIXES + ('.webp', '.heic', '.pdf')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+# Behind nginx (see nginx.conf) let it stream protected uploads via X-Accel-Redirect
+app.config['USE_X_ACCEL_REDIRECT'] = os.getenv('USE_X_ACCEL_REDIRECT', '').lower() in ('1', 'true', 'yes')
 
 # Create upload folder if it doesn't exist
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(QR_FOLDER, exist_ok=True)
+os.makedirs(RECEIPT_CACHE_FOLDER, exist_ok=True)
+os.makedirs(PROOF_FOLDER, exist_ok=True)
 os.makedirs('gym_data', exist_ok=True)
 
+# Proofs uploaded before PROOF_FOLDER existed were public under static/uploads
+for _name in os.listdir(UPLOAD_FOLDER):
+    if _name.startswith('proof_'):
+        try:
+            os.replace(os.path.join(UPLOAD_FOLDER, _name), os.path.join(PROOF_FOLDER, _name))
+        except FileNotFoundError:
+            pass  # another worker moved it first
+
 # Initialize Auth Manager
 auth_manager = AuthManager()
 
+# Subscription status / plan change rarely, so cache them briefly in Redis
+SUBSCRIPTION_CACHE_TTL = 60  # seconds
+
+def is_subscription_active(username):
+    """Cached wrapper around auth_manager.is_subscription_active"""
+    if redis_client is None:
+        return auth_manager.is_subscription_active(username)
+    
+    cached = redis_client.get(f"sub:{username}")
+    if cached is not None:
+        return cached == b"1"
+    
+    active = auth_manager.is_subscription_active(username)
+    redis_client.setex(f"sub:{username}", SUBSCRIPTION_CACHE_TTL, b"1" if active else b"0")
+    return active
+
+def get_user_plan(username):
+    """Cached lookup of the user's plan ('standard' if unknown)"""
+    if redis_client is None:
+        return auth_manager.get_plan(username)
+    
+    cached = redis_client.get(f"plan:{username}")
+    if cached is not None:
+        return cached.decode('utf-8')
+    
+    plan = auth_manager.get_plan(username)
+    redis_client.setex(f"plan:{username}", SUBSCRIPTION_CACHE_TTL, plan)
+    return plan
+
+def invalidate_subscription_cache(username):
+    """Drop cached subscription data after a renewal or approval"""
+    if redis_client is not None:
+        redis_client.delete(f"sub:{username}", f"plan:{username}")
+
+# Per-user GymManager cache (LRU). A manager only holds the user's gym id and
+# uses the per-request DB session, so it is safe to reuse across requests.
+GYM_CACHE_SIZE = 256
+_gym_cache = OrderedDict()
+_gym_cache_lock = threading.Lock()
+
 def get_gym():
     """Get GymManager instance for logged-in user"""
-    if 'logged_in' not in session:
+    if not g.logged_in:
         return None
-    username = session.get('username')
-    return GymManager(username)  # Now uses email directly
+    username = g.username
+    
+    with _gym_cache_lock:
+        gym = _gym_cache.get(username)
+        if gym is not None:
+            _gym_cache.move_to_end(username)
+    
+    if gym is None:
+        gym = GymManager(username)  # Now uses email directly
+        if gym.gym_id is not None:
+            with _gym_cache_lock:
+                _gym_cache[username] = gym
+                while len(_gym_cache) > GYM_CACHE_SIZE:
+                    _gym_cache.popitem(last=False)
+    
+    # Kept for the rest of the request; its changes are committed in after_request
+    g.gym = gym
+    return gym
+
+def require_gym(view):
+    """Redirect to login unless there is a gym; the gym is kept on g.gym for the request"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.gym = get_gym()
+        if not g.gym:
+            return redirect(url_for('auth'))
+        return view(*args, **kwargs)
+    return wrapper
+
+@app.after_request
+def commit_gym_changes(response):
+    """Commit everything the request changed in one transaction"""
+    gym = g.get('gym')
+    if gym is not None:
+        gym.flush()
+    return response
+
+@app.teardown_appcontext
+def shutdown_session(exception=None):
+    """Release the request's DB session back to the pool (uncommitted changes are rolled back)"""
+    remove_session()
 
 @app.context_processor
 def inject_gym_details():
     context = {}
-    gym = get_gym()
+    gym = g.gym if 'gym' in g else get_gym()
     if gym:
         details = gym.get_gym_details()
         if 'currency' not in details: details['currency'] = '$'
@@ -67,75 +207,224 @@ def inject_gym_details():
         context['gym_details'] = {'name': 'Gym Manager', 'logo': None, 'currency': '$'}
         
     # Inject User Plan info
-    if 'logged_in' in session:
-        user = auth_manager.users.get(session['username'], {})
-        context['user_plan'] = user.get('plan', 'standard')
+    if g.logged_in:
+        context['user_plan'] = get_user_plan(g.username)
     
     return context
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Month dropdown (12 past + current + 24 future = 37), rebuilt once per day
+_months_cache = {'date': None, 'list': None, 'current': None}
+
+def _available_months():
+    """Return (available_months, current_month) for the month selectors"""
+    today = datetime.now().date()
+    if _months_cache['date'] != today:
+        y, m = today.year, today.month - 12
+        while m <= 0:
+            y -= 1
+            m += 12
+        
+        months = []
+        for _ in range(37):
+            months.append({'value': f'{y:04d}-{m:02d}', 'label': datetime(y, m, 1).strftime('%B %Y')})
+            m += 1
+            if m == 13:
+                m = 1
+                y += 1
+        
+        _months_cache.update(date=today, list=months[::-1], current=today.strftime('%Y-%m'))
+    return _months_cache['list'], _months_cache['current']
+
+def allowed_file(filename, suffixes=_ALLOWED_SUFFIXES):
+    return filename.lower().endswith(suffixes)
+
+def stream_multipart(file_fields, value_fields):
+    """Parse a multipart POST straight off the socket.
+
+    ``file_fields`` maps field names to streaming targets (e.g. a
+    FileTarget writing straight to disk, no Werkzeug spool file); plain
+    fields are returned as decoded strings.
+    """
+    content_type = request.headers.get('Content-Type', '')
+    if not content_type.startswith('multipart/form-data'):
+        abort(400)
+    parser = StreamingFormDataParser(headers={'Content-Type': content_type})
+    
+    for name, target in file_fields.items():
+        parser.register(name, target)
+    
+    values = {name: ValueTarget() for name in value_fields}
+    for name, target in values.items():
+        parser.register(name, target)
+    
+    # request.stream is already capped by MAX_CONTENT_LENGTH
+    try:
+        while chunk := request.stream.read(65536):
+            parser.data_received(chunk)
+    except ParseFailedException:
+        # Malformed body: drop whatever was written to disk so far
+        for target in file_fields.values():
+            if os.path.exists(target.filename):
+                os.remove(target.filename)
+        abort(400)
+    
+    return {name: target.value.decode('utf-8') for name, target in values.items()}
+
+class Base64FileTarget(BaseTarget):
+    """Decode a base64 data URL field (camera capture) into a file as it streams in"""
+    
+    def __init__(self, filename):
+        super().__init__()
+        self.filename = filename
+        self._fd = None
+        self._in_header = True
+        self._pending = b''
+    
+    def on_start(self):
+        self._fd = open(self.filename, 'wb')
+    
+    def on_data_received(self, chunk):
+        data = self._pending + chunk
+        
+        # Skip the "data:image/png;base64," prefix
+        if self._in_header:
+            if b',' not in data:
+                self._pending = data
+                return
+            data = data.partition(b',')[2]
+            self._in_header = False
+        
+        # Only decode whole 4-character groups; carry the rest over
+        usable = len(data) - len(data) % 4
+        self._pending = data[usable:]
+        if usable:
+            self._fd.write(base64.b64decode(data[:usable]))
+    
+    def on_finish(self):
+        if self._pending and not self._in_header:
+            self._fd.write(base64.b64decode(self._pending))
+        self._fd.close()
+
+def upload_tmp_path():
+    """Unique temp path in the upload folder for a part whose filename isn't known yet"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"upload_{uuid.uuid4().hex}.part")
+
+def finish_upload(target, tmp_path, prefix, suffixes=_ALLOWED_SUFFIXES, folder=UPLOAD_FOLDER):
+    """Rename a streamed upload to its final name, or discard it. Returns the filename or None."""
+    original = target.multipart_filename
+    if original and allowed_file(original, suffixes) and os.path.exists(tmp_path):
+        filename = secure_filename(f"{prefix}{datetime.now().strftime('%Y%m%d%H%M%S')}_{original}")
+        os.replace(tmp_path, os.path.join(folder, filename))
+        return filename
+    
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return None
+
+def save_content_addressed(file, prefix):
+    """Save an upload under a name derived from its contents (the same file uploaded twice is stored once)"""
+    ext = os.path.splitext(file.filename)[1].lower()
+    h = hashlib.blake2b(digest_size=12)
+    tmp_path = upload_tmp_path()
+    
+    # Hash while writing, so the file is read only once
+    with open(tmp_path, 'wb') as out:
+        while chunk := file.stream.read(65536):
+            h.update(chunk)
+            out.write(chunk)
+    
+    filename = f"{prefix}{h.hexdigest()}{ext}"
+    final_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if os.path.exists(final_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, final_path)
+    return filename
 
 @app.route('/')
 def index():
-    if 'logged_in' not in session:
+    if not g.logged_in:
         return redirect(url_for('auth'))
     return redirect(url_for('dashboard'))
 
-import stripe
-
 # STRIPE CONFIGURATION - Loaded from environment variables
 # Get your keys from https://dashboard.stripe.com/apikeys
+# (the stripe module itself is imported on first use, see tasks.get_stripe)
 app.config['STRIPE_PUBLIC_KEY'] = os.getenv('STRIPE_PUBLIC_KEY', '')
 app.config['STRIPE_SECRET_KEY'] = os.getenv('STRIPE_SECRET_KEY', '')
-stripe.api_key = app.config['STRIPE_SECRET_KEY']
+
+# Checkout line item for the Pro subscription (built once)
+SUBSCRIPTION_LINE_ITEMS = [{
+    'price_data': {
+        'currency': 'usd',
+        'product_data': {
+            'name': 'Gym Manager Pro Subscription',
+            'images': ['https://i.imgur.com/EHyR2nP.png'],
+        },
+        'unit_amount': 6000, # $60.00
+    },
+    'quantity': 1,
+}]
 
 # GOOGLE OAUTH CONFIGURATION - Loaded from environment variables
 app.config['GOOGLE_CLIENT_ID'] = os.getenv('GOOGLE_CLIENT_ID', '')
 
+# Google's token-signing certs are served with a long max-age; cache them
+# over HTTP instead of fetching them again on every login
+_google_request = None
+
+def get_google_request():
+    """Shared google-auth transport with an HTTP cache (imported on first login)"""
+    global _google_request
+    if _google_request is None:
+        import requests
+        from cachecontrol import CacheControl
+        from google.auth.transport import requests as google_requests
+        _google_request = google_requests.Request(session=CacheControl(requests.Session()))
+    return _google_request
+
+@app.before_request
+def load_session_user():
+    """Read the login state from the session once per request"""
+    g.username = session.get('username')
+    g.logged_in = bool(g.username and session.get('logged_in'))
+
 @app.before_request
 def check_subscription():
     # Public endpoints that don't need subscription
-    public_endpoints = ['auth', 'google_login', 'static', 'subscription', 'logout', 'create_checkout_session', 'payment_success', 'payment_cancel']
+    public_endpoints = ['auth', 'google_login', 'static', 'subscription', 'logout', 'create_checkout_session', 'payment_success', 'payment_cancel', 'subscription_status', 'manual_payment']
+    
+    if request.endpoint in public_endpoints or not g.logged_in:
+        return
     
-    if request.endpoint in public_endpoints or not session.get('logged_in'):
+    # Super admins must always be able to review and approve payments
+    if g.username in ADMIN_EMAILS:
         return
 
-    username = session.get('username')
-    if not auth_manager.is_subscription_active(username):
+    username = g.username
+    if not is_subscription_active(username):
         session['needs_payment'] = True
         return redirect(url_for('subscription'))
 
 @app.route('/subscription')
 def subscription():
-    username = session.get('username')
-    if auth_manager.is_subscription_active(username):
+    username = g.username
+    if is_subscription_active(username):
         return redirect(url_for('dashboard'))
         
     # Check if user is pending approval
-    user = auth_manager.users.get(username, {})
-    if user.get('subscription_status') == 'pending':
+    if auth_manager.get_subscription_status(username) == 'pending':
         return render_template('payment_pending.html')
         
     return render_template('payment_select.html', key=app.config['STRIPE_PUBLIC_KEY'])
 
 @app.route('/create_checkout_session', methods=['POST'])
 def create_checkout_session():
-    username = session.get('username')
+    username = g.username
     try:
-        checkout_session = stripe.checkout.Session.create(
+        checkout_session = get_stripe().checkout.Session.create(
             payment_method_types=['card'],
-            line_items=[{
-                'price_data': {
-                    'currency': 'usd',
-                    'product_data': {
-                        'name': 'Gym Manager Pro Subscription',
-                        'images': ['https://i.imgur.com/EHyR2nP.png'],
-                    },
-                    'unit_amount': 6000, # $60.00
-                },
-                'quantity': 1,
-            }],
+            line_items=SUBSCRIPTION_LINE_ITEMS,
             mode='payment',
             success_url=url_for('payment_success', _external=True) + '?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=url_for('payment_cancel', _external=True),
@@ -148,17 +437,67 @@ def create_checkout_session():
 
 @app.route('/payment_success')
 def payment_success():
-    username = session.get('username')
+    username = g.username
     if not username: return redirect(url_for('auth'))
     
-    # In a production app, verify the session_id with Stripe here
-    # session_id = request.args.get('session_id')
+    session_id = request.args.get('session_id')
+    if not session_id:
+        abort(400)
+    
+    # A checkout session renews at most once: renew_subscription records its id
+    # under a unique constraint, so refreshes and retried redirects are harmless.
+    
+    # Verify with Stripe and renew in the background; the page polls for the result
+    queue = get_queue()
+    if queue is not None:
+        # Short lock so a refresh doesn't queue a second job while the first runs;
+        # it expires, so a failed job can be retried by reloading the page
+        if redis_client.set(f"stripe:checkout:{session_id}", 1, nx=True, ex=300):
+            job = queue.enqueue(verify_and_renew, username, session_id)
+            session['payment_job'] = job.id
+            session['payment_checkout'] = session_id
+        session.pop('needs_payment', None)
+        return render_template('payment_processing.html')
+    
+    # No worker configured - verify inline
+    if verify_and_renew(username, session_id):
+        invalidate_subscription_cache(username)
+        flash('Payment Successful! Thank you for your subscription. ✅', 'success')
+        session.pop('needs_payment', None)
+        return redirect(url_for('dashboard'))
     
-    # Renew subscription
-    auth_manager.renew_subscription(username)
-    flash('Payment Successful! Thank you for your subscription. ✅', 'success')
-    session.pop('needs_payment', None)
-    return redirect(url_for('dashboard'))
+    flash('Could not confirm your payment. Please contact support if you were charged.', 'error')
+    return redirect(url_for('subscription'))
+
+@app.route('/subscription_status')
+def subscription_status():
+    """Polled by the payment processing page"""
+    username = g.username
+    if not username:
+        return jsonify({'active': False}), 401
+    
+    active = is_subscription_active(username)
+    
+    # Let the page stop polling if the verification job failed or found no payment
+    failed = False
+    job_id = session.get('payment_job')
+    if job_id and not active and redis_client is not None:
+        from rq.job import Job
+        from rq.exceptions import NoSuchJobError
+        try:
+            status = Job.fetch(job_id, connection=redis_client).get_status()
+            failed = status == 'failed' or status == 'finished'
+        except NoSuchJobError:
+            failed = True
+    
+    if job_id and (active or failed):
+        session.pop('payment_job', None)
+        checkout_id = session.pop('payment_checkout', None)
+        # Release the enqueue lock so reloading the payment page retries at once
+        if failed and checkout_id:
+            redis_client.delete(f"stripe:checkout:{checkout_id}")
+    
+    return jsonify({'active': active, 'failed': failed})
 
 @app.route('/payment_cancel')
 def payment_cancel():
@@ -167,52 +506,75 @@ def payment_cancel():
 
 @app.route('/manual_payment', methods=['GET', 'POST'])
 def manual_payment():
-    username = session.get('username')
+    username = g.username
     if not username: return redirect(url_for('auth'))
     
     if request.method == 'POST':
-        if 'payment_proof' in request.files:
-            file = request.files['payment_proof']
-            if file and file.filename:
-                filename = secure_filename(f"proof_{username}_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                
-                # Update user status to pending
-                auth_manager.set_payment_pending(username, filename)
-                
-                flash('Proof uploaded! Waiting for admin approval.', 'success')
-                return redirect(url_for('subscription'))
+        tmp_path = upload_tmp_path()
+        proof = FileTarget(tmp_path)
+        stream_multipart({'payment_proof': proof}, [])
+        filename = finish_upload(proof, tmp_path, f"proof_{username}_", _PROOF_SUFFIXES, PROOF_FOLDER)
+        if filename:
+            # Update user status to pending
+            auth_manager.set_payment_pending(username, filename)
+            
+            flash('Proof uploaded! Waiting for admin approval.', 'success')
+            return redirect(url_for('subscription'))
+        
+        if proof.multipart_filename:
+            flash('Invalid file type! Upload an image (PNG, JPG, GIF, WEBP, HEIC) or a PDF.', 'error')
+        else:
+            flash('No file selected!', 'error')
                 
     return render_template('payment_manual.html')
 
 # Admin Access Control - Loaded from environment variables
-ADMIN_EMAILS = os.getenv('ADMIN_EMAILS', 'admin@gym.com').split(',')
+ADMIN_EMAILS = frozenset(email.strip() for email in os.getenv('ADMIN_EMAILS', 'admin@gym.com').split(','))
+
+def require_admin(view):
+    """Only allow super admins (ADMIN_EMAILS) through"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if g.username not in ADMIN_EMAILS:
+            flash('Access Denied: Super Admin only.', 'error')
+            return redirect(url_for('dashboard'))
+        return view(*args, **kwargs)
+    return wrapper
 
 @app.route('/super_admin')
+@require_admin
 def super_admin():
-    if session.get('username') not in ADMIN_EMAILS:
-        flash('Access Denied: Super Admin only.', 'error')
-        return redirect(url_for('dashboard'))
-    
     pending_users = auth_manager.get_pending_approvals()
     return render_template('super_admin.html', pending_users=pending_users)
 
 @app.route('/approve_payment/<target_username>')
+@require_admin
 def approve_payment(target_username):
-    if session.get('username') not in ADMIN_EMAILS:
-        flash('Access Denied.', 'error')
-        return redirect(url_for('dashboard'))
-        
-    # Verify admin here logic
+    # Approving only acts on a pending proof, so a repeated click can't renew twice
+    if auth_manager.get_subscription_status(target_username) != 'pending':
+        flash(f'User {target_username} has no pending payment to approve.', 'info')
+        return redirect(url_for('super_admin'))
+    
     if auth_manager.approve_manual_payment(target_username):
+        invalidate_subscription_cache(target_username)
         flash(f'User {target_username} approved!', 'success')
-        
-        # Optional: Add a real Stripe payment record or just the manual one (already done in AuthManager)
     else:
         flash('Approval failed.', 'error')
     return redirect(url_for('super_admin'))
 
+@app.route('/payment_proof/<path:filename>')
+@require_admin
+def payment_proof(filename):
+    """Serve a manual payment proof to super admins"""
+    filename = secure_filename(filename)
+    if app.config['USE_X_ACCEL_REDIRECT']:
+        # nginx sends the file itself from its internal /protected/ location
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = f'/protected/{filename}'
+        del response.headers['Content-Type']
+        return response
+    return send_from_directory(PROOF_FOLDER, filename)
+
 @app.route('/auth', methods=['GET', 'POST'])
 def auth():
     if request.method == 'POST':
@@ -248,7 +610,8 @@ def google_login():
         if not client_id:
             flash('Google Login not configured. Please contact administrator.', 'error')
             return redirect(url_for('auth'))
-        idinfo = id_token.verify_oauth2_token(token, google_requests.Request(), client_id)
+        from google.oauth2 import id_token
+        idinfo = id_token.verify_oauth2_token(token, get_google_request(), client_id)
 
         # ID token is valid. Get the user's Google Account ID from the decoded token.
         email = idinfo['email']
@@ -365,9 +728,9 @@ def reset_password():
 
 
 @app.route('/schedule', methods=['GET', 'POST'])
+@require_gym
 def schedule():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if request.method == 'POST':
         name = request.form.get('name')
@@ -383,9 +746,9 @@ def schedule():
     return render_template('schedule.html', classes=gym.get_classes(), members=gym.get_all_members())
 
 @app.route('/expenses', methods=['GET', 'POST'])
+@require_gym
 def expenses():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if request.method == 'POST':
         category = request.form.get('category')
@@ -426,9 +789,9 @@ def expenses():
                          gym_details=gym.get_gym_details())
 
 @app.route('/delete_expense/<expense_id>', methods=['POST'])
+@require_gym
 def delete_expense(expense_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if gym.delete_expense(expense_id):
         flash('Expense deleted successfully!', 'success')
@@ -438,9 +801,9 @@ def delete_expense(expense_id):
     return redirect(url_for('expenses'))
 
 @app.route('/book_class/<class_id>', methods=['POST'])
+@require_gym
 def book_class(class_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member_id = request.form.get('member_id')
     if gym.book_class(member_id, class_id):
@@ -451,39 +814,31 @@ def book_class(class_id):
     return redirect(url_for('schedule'))
 
 @app.route('/reports')
+@require_gym
 def reports():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
-    
-    # Calculate stats
-    total_members = len(gym.get_all_members())
+    gym = g.gym
     
-    # Current month revenue
+    # Calculate stats (members, current month revenue, paid/unpaid)
     current_month = datetime.now().strftime('%Y-%m')
-    status = gym.get_payment_status(current_month)
-    monthly_revenue = sum(m.get('amount', 0) for m in status['paid'])
+    stats = gym.dashboard_stats(current_month)
     
     # Total check-ins
-    total_checkins = 0
-    if 'attendance' in gym.data:
-        for visits in gym.data['attendance'].values():
-            total_checkins += len(visits)
+    total_checkins = gym.total_checkins()
     
     # Revenue trend (last 6 months)
-    revenue_months = []
-    revenue_data = []
-    for i in range(5, -1, -1):
-        month = (datetime.now().replace(day=1) - timedelta(days=30*i)).strftime('%Y-%m')
-        revenue_months.append(month)
-        month_status = gym.get_payment_status(month)
-        revenue_data.append(sum(m.get('amount', 0) for m in month_status['paid']))
+    revenue_months = [current_month]
+    for _ in range(5):
+        revenue_months.insert(0, previous_month(revenue_months[0]))
+    
+    revenue_by_month = gym.monthly_revenue_since(revenue_months[0])
+    revenue_data = [revenue_by_month.get(month, 0) for month in revenue_months]
     
     return render_template('reports.html',
-                         total_members=total_members,
-                         monthly_revenue=monthly_revenue,
+                         total_members=stats.total,
+                         monthly_revenue=stats.revenue,
                          total_checkins=total_checkins,
-                         paid_count=len(status['paid']),
-                         unpaid_count=len(status['unpaid']),
+                         paid_count=len(stats.paid),
+                         unpaid_count=len(stats.unpaid),
                          revenue_months=revenue_months,
                          revenue_data=revenue_data)
 
@@ -498,130 +853,74 @@ def reset_admin():
     return redirect(url_for('dashboard'))
 
 @app.route('/dashboard')
+@require_gym
 def dashboard():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
 
-    # Generate months for dropdown
-    current_date = datetime.now()
-    # Snap to first of current month, then go back 12 months
-    start_date = current_date.replace(day=1) - pd.DateOffset(months=12)
+    available_months, this_month = _available_months()
     
-    # Generate range and format as (value, label) tuples (12 past + current + 24 future = 37)
-    dates = pd.date_range(start=start_date, periods=37, freq='MS')
     # Check if month requested
-    selected_month = request.args.get('month')
-    if not selected_month:
-        current_month = request.args.get('month', datetime.now().strftime('%Y-%m'))
-    status = gym.get_payment_status(current_month)
-    
-    # Calculate revenue
-    revenue = sum(m.get('amount', 0) for m in status['paid'])
+    current_month = request.args.get('month') or this_month
+    stats = gym.dashboard_stats(current_month)
     
     # Calculate revenue change vs last month
-    last_month = (datetime.strptime(current_month, '%Y-%m') - timedelta(days=30)).strftime('%Y-%m')
-    last_status = gym.get_payment_status(last_month)
-    last_revenue = sum(m.get('amount', 0) for m in last_status['paid'])
-    
     revenue_change = 0
-    if last_revenue > 0:
-        revenue_change = round(((revenue - last_revenue) / last_revenue) * 100, 1)
-    
-    # Count expiring memberships (next 3 days)
-    expiring_count = 0
-    today = datetime.now().date()
-    all_members = gym.get_all_members()
-    
-    # Check if it's a dict or list
-    if isinstance(all_members, dict):
-        members_to_check = all_members.values()
-    else:
-        members_to_check = all_members
-    
-    for member in members_to_check:
-        # Check if trial is expiring
-        if member.get('trial_end'):
-            trial_end = datetime.strptime(member['trial_end'], '%Y-%m-%d').date()
-            days_until_expiry = (trial_end - today).days
-            if 0 <= days_until_expiry <= 3:
-                expiring_count += 1
-    
-    # Total members
-    total_members = len(gym.get_all_members())
-    
-    # Available months for selector
-    available_months = []
-    for i in range(12):
-        month_date = datetime.now() - timedelta(days=30*i)
-        available_months.append({
-            'value': month_date.strftime('%Y-%m'),
-            'label': month_date.strftime('%B %Y')
-        })
+    if stats.last_revenue > 0:
+        revenue_change = round(((stats.revenue - stats.last_revenue) / stats.last_revenue) * 100, 1)
     
     return render_template('dashboard.html', 
-                         paid=status['paid'], 
-                         unpaid=status['unpaid'],
-                         revenue=revenue,
+                         paid=stats.paid, 
+                         unpaid=stats.unpaid,
+                         revenue=stats.revenue,
                          revenue_change=revenue_change,
-                         total_members=total_members,
-                         expiring_count=expiring_count,
+                         total_members=stats.total,
+                         expiring_count=stats.expiring_count,
                          current_month=current_month,
                          available_months=available_months,
                          gym_details=gym.get_gym_details())
 
 @app.route('/add_member', methods=['GET', 'POST'])
+@require_gym
 def add_member():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
-    
-    # Generate months for dropdown
-    current_date = datetime.now()
-    # Snap to first of current month, then go back 12 months
-    start_date = current_date.replace(day=1) - pd.DateOffset(months=12)
+    gym = g.gym
     
-    # Generate range and format as (value, label) tuples (12 past + current + 24 future = 37)
-    dates = pd.date_range(start=start_date, periods=37, freq='MS')
-    available_months = [{'value': d.strftime('%Y-%m'), 'label': d.strftime('%B %Y')} for d in dates][::-1]
+    available_months, current_month = _available_months()
     
     if request.method == 'POST':
-        name = request.form.get('name')
-        phone = request.form.get('phone')
-        membership_type = request.form.get('membership_type', 'Gym')
+        tmp_path = upload_tmp_path()
+        camera_path = upload_tmp_path()
+        photo = FileTarget(tmp_path)
+        form = stream_multipart(
+            {'photo': photo, 'camera_photo': Base64FileTarget(camera_path)},
+            ['name', 'phone', 'membership_type', 'initial_month', 'initial_amount',
+             'joined_date', 'email', 'start_trial']
+        )
+        name = form['name']
+        phone = form['phone']
         
         # Initial Payment data
-        initial_month = request.form.get('initial_month')
+        initial_month = form['initial_month']
         try:
-            initial_amount = float(request.form.get('initial_amount', 0) or 0)
+            initial_amount = float(form['initial_amount'] or 0)
         except ValueError:
             initial_amount = 0
             
-        photo_path = None
-        
-        # Handle file upload
-        if 'photo' in request.files:
-            file = request.files['photo']
-            if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                photo_path = filename
+        # Handle file upload (already streamed to disk)
+        photo_path = finish_upload(photo, tmp_path, '')
         
-        # Handle camera capture (base64 data)
-        elif 'camera_photo' in request.form and request.form['camera_photo']:
-            import base64
-            photo_data = request.form['camera_photo'].split(',')[1]
-            photo_bytes = base64.b64decode(photo_data)
+        # Handle camera capture (base64 data, already decoded to disk)
+        if not photo_path and os.path.exists(camera_path) and os.path.getsize(camera_path) > 0:
             filename = f"camera_{datetime.now().strftime('%Y%m%d%H%M%S')}.png"
-            filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            with open(filepath, 'wb') as f:
-                f.write(photo_bytes)
+            os.replace(camera_path, os.path.join(app.config['UPLOAD_FOLDER'], filename))
             photo_path = filename
+        elif os.path.exists(camera_path):
+            os.remove(camera_path)
         
         try:
-            membership_type = request.form.get('membership_type', 'Gym')
-            joined_date = request.form.get('joined_date')
-            email = request.form.get('email')
-            start_trial = request.form.get('start_trial') == 'on'
+            membership_type = form['membership_type'] or 'Gym'
+            joined_date = form['joined_date']
+            email = form['email']
+            start_trial = form['start_trial'] == 'on'
             
             # If initial payment overrides trial, we can decide logic.
             # Here: If they pay, trial is False. If they don't and check trial, it's True.
@@ -629,6 +928,7 @@ def add_member():
                 start_trial = False
                 
             member_id = gym.add_member(name, phone, photo_path, membership_type, joined_date, is_trial=start_trial, email=email)
+            member_qr_path(member_id)
             
             # Record initial payment if amount > 0
             if initial_amount > 0 and initial_month:
@@ -647,13 +947,13 @@ def add_member():
     
     return render_template('add_member.html', 
                          available_months=available_months, 
-                         current_month=current_date.strftime('%Y-%m'),
-                         today=current_date.strftime('%Y-%m-%d'))
+                         current_month=current_month,
+                         today=datetime.now().strftime('%Y-%m-%d'))
 
 @app.route('/fees', methods=['GET', 'POST'])
+@require_gym
 def fees():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if request.method == 'POST':
         member_id = request.form.get('member_id')
@@ -678,7 +978,7 @@ def fees():
     
     for member in all_members:
         member_id = member.get('id')
-        payment_history = gym.get_payment_history(member_id)
+        payment_history = gym.get_member_fees(member_id)
         
         for payment in payment_history:
             fee_records.append({
@@ -698,11 +998,7 @@ def fees():
     current_month_records = [r for r in fee_records if r['month'] == current_month]
     current_month_total = sum(r['amount'] for r in current_month_records)
     
-    # Generate months for dropdown
-    current_date = datetime.now()
-    start_date = current_date.replace(day=1) - pd.DateOffset(months=12)
-    dates = pd.date_range(start=start_date, periods=37, freq='MS')
-    available_months = [{'value': d.strftime('%Y-%m'), 'label': d.strftime('%B %Y')} for d in dates][::-1]
+    available_months, _ = _available_months()
     
     return render_template('fees.html', 
                          members=all_members,
@@ -713,58 +1009,76 @@ def fees():
                          current_month_total=current_month_total,
                          gym_details=gym.get_gym_details())
 
+def make_temp_path(suffix):
+    """Reserve a temp file path for a generated download"""
+    tmp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    tmp.close()
+    return tmp.name
+
+def send_temp_file(path, **kwargs):
+    """Send a generated file from disk (sendfile/Range capable) and delete it afterwards"""
+    response = send_file(path, conditional=True, **kwargs)
+    
+    @response.call_on_close
+    def _cleanup():
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+    
+    return response
+
 @app.route('/download_excel')
+@require_gym
 def download_excel():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     current_month = datetime.now().strftime('%Y-%m')
     status = gym.get_payment_status(current_month)
     
-    # Prepare data for Excel
-    data = []
+    # Write rows straight into a write-only workbook (no DataFrame)
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Members')
+    ws.append(['ID', 'Name', 'Phone', 'Status', 'Last Payment'])
     for member in status['paid']:
-        data.append({
-            'ID': member['id'],
-            'Name': member['name'],
-            'Phone': member['phone'],
-            'Status': 'PAID',
-            'Last Payment': member.get('last_paid', 'N/A')
-        })
-    
+        ws.append([member.id, member.name, member.phone, 'PAID', member.date])
     for member in status['unpaid']:
-        data.append({
-            'ID': member['id'],
-            'Name': member['name'],
-            'Phone': member['phone'],
-            'Status': 'UNPAID',
-            'Last Payment': 'N/A'
-        })
-    
-    df = pd.DataFrame(data)
+        ws.append([member.id, member.name, member.phone, 'UNPAID', 'N/A'])
     
-    # Create Excel file
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Members')
-    output.seek(0)
+    tmp_path = make_temp_path('.xlsx')
+    wb.save(tmp_path)
     
     filename = f'gym_members_{current_month}.xlsx'
-    return send_file(output, download_name=filename, as_attachment=True)
+    return send_temp_file(tmp_path, download_name=filename, as_attachment=True)
+
+def member_qr_path(member_id):
+    """Path to the member's QR code PNG, generated once and cached on disk"""
+    path = os.path.join(QR_FOLDER, f"{member_id}.png")
+    if not os.path.exists(path):
+        import qrcode
+        qr = qrcode.QRCode(version=1, box_size=10, border=2)
+        qr.add_data(str(member_id))
+        qr.make(fit=True)
+        qr.make_image(fill_color="black", back_color="white").save(path)
+    return path
 
 @app.route('/card/<member_id>')
+@require_gym
 def generate_card(member_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
     if not member:
         flash('Member not found!', 'error')
         return redirect(url_for('dashboard'))
     
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+    
     # Create PDF
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
+    tmp_path = make_temp_path('.pdf')
+    c = canvas.Canvas(tmp_path, pagesize=letter)
     width, height = letter
     
     # Card background
@@ -781,24 +1095,13 @@ def generate_card(member_id):
         photo_path = os.path.join(app.config['UPLOAD_FOLDER'], member['photo'])
         if os.path.exists(photo_path):
             try:
-                img = ImageReader(photo_path)
-                c.drawImage(img, 70, height - 330, width=80, height=100, preserveAspectRatio=True)
+                # ReportLab opens the file itself
+                c.drawImage(photo_path, 70, height - 330, width=80, height=100, preserveAspectRatio=True)
             except:
                 pass
     
-    # QR Code
-    qr = qrcode.QRCode(version=1, box_size=10, border=2)
-    qr.add_data(member_id)
-    qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Save QR to buffer to draw
-    qr_buffer = BytesIO()
-    qr_img.save(qr_buffer)
-    qr_buffer.seek(0)
-    
-    # Draw QR Code on card
-    c.drawImage(ImageReader(qr_buffer), 270, height - 330, width=70, height=70)
+    # QR Code (cached PNG, member IDs never change)
+    c.drawImage(member_qr_path(member['id']), 270, height - 330, width=70, height=70)
     
     # Member details
     c.setFont("Helvetica", 12)
@@ -808,20 +1111,18 @@ def generate_card(member_id):
     c.drawString(170, height - 290, f"Joined: {member['joined_date']}")
     
     c.save()
-    buffer.seek(0)
     
-    return send_file(buffer, download_name=f'card_{member_id}.pdf', as_attachment=True, mimetype='application/pdf')
+    return send_temp_file(tmp_path, download_name=f'card_{member_id}.pdf', as_attachment=True, mimetype='application/pdf')
 
 @app.route('/scanner')
+@require_gym
 def scanner():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
     return render_template('scanner.html')
 
 @app.route('/scan_check/<member_id>')
+@require_gym
 def scan_check(member_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     # Determine status
     current_month = datetime.now().strftime('%Y-%m')
@@ -840,19 +1141,20 @@ def scan_check(member_id):
         gym.log_attendance(member_id)
     # Special check for trial
     elif not is_paid and member.get('is_trial'):
-        today = datetime.now().strftime('%Y-%m-%d')
-        if member.get('trial_end_date') >= today:
+        trial_end = member.get('trial_end_date')
+        if trial_end and date.fromisoformat(trial_end) >= date.today():
              status = 'TRIAL'
         else:
             status = 'ACCESS DENIED - TRIAL EXPIRED'
     else:
         status = 'ACCESS DENIED - FEE PENDING'
     
-    # Get attendance history
-    attendance_history = gym.get_attendance(member_id)
+    # Only the latest visits are shown, plus a total
+    attendance_history = gym.get_attendance(member_id, limit=5)
+    visit_count = gym.count_attendance(member_id)
     
     # Get payment details
-    payment_history = gym.get_payment_history(member_id)
+    payment_history = gym.get_member_fees(member_id, limit=1)
     last_payment = payment_history[0] if payment_history else None
              
     return render_template('scan_result.html', 
@@ -860,22 +1162,21 @@ def scan_check(member_id):
                          status=status, 
                          month=current_month,
                          attendance_history=attendance_history,
+                         visit_count=visit_count,
                          last_payment=last_payment,
                          is_paid=is_paid,
                          gym_details=gym.get_gym_details())
 
 @app.route('/member/<member_id>', methods=['GET', 'POST'])
+@require_gym
 def member_details(member_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
     if not member:
         flash('Member not found!', 'error')
         return redirect(url_for('dashboard'))
         
-    attendance_history = gym.get_attendance(member_id)
-        
     if request.method == 'POST':
         month = request.form.get('month')
         amount = float(request.form.get('amount') or 0)
@@ -890,27 +1191,24 @@ def member_details(member_id):
     
         return redirect(url_for('member_details', member_id=member_id))
     
-    history = gym.get_member_fee_history(member_id)
+    attendance_history = gym.get_attendance(member_id)
     
-    # Generate months for payment dropdown (12 past + current + 24 future = 37)
-    current_date = datetime.now()
-    start_date = current_date.replace(day=1) - pd.DateOffset(months=12)
-    dates = pd.date_range(start=start_date, periods=37, freq='MS')
-    available_months = [{'value': d.strftime('%Y-%m'), 'label': d.strftime('%B %Y')} for d in dates][::-1]
+    # Months for payment dropdown
+    available_months, current_month = _available_months()
     
     return render_template('member_details.html', 
                          member=member, 
                          gym_details=gym.get_gym_details(), 
-                         history=gym.get_payment_history(member_id),
+                         history=gym.get_member_fees(member_id),
                          attendance_history=attendance_history,
-                         current_month=datetime.now().strftime('%Y-%m'),
+                         current_month=current_month,
                          today=datetime.now().strftime('%Y-%m-%d'),
                          available_months=available_months)
 
 @app.route('/member/<member_id>/delete_fee/<month>', methods=['POST'])
+@require_gym
 def delete_fee_record(member_id, month):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if gym.delete_fee(member_id, month):
         flash(f'Payment for {month} deleted!', 'success')
@@ -920,9 +1218,9 @@ def delete_fee_record(member_id, month):
     return redirect(url_for('member_details', member_id=member_id))
 
 @app.route('/member/<member_id>/edit_fee/<month>', methods=['GET', 'POST'])
+@require_gym
 def edit_fee_record(member_id, month):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
     if not member or not gym.is_fee_paid(member_id, month):
@@ -947,9 +1245,9 @@ def edit_fee_record(member_id, month):
     return render_template('edit_fee.html', member=member, month=month, fee=fee_info)
 
 @app.route('/member/<member_id>/edit', methods=['GET', 'POST'])
+@require_gym
 def edit_member(member_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
     if not member:
@@ -972,11 +1270,14 @@ def edit_member(member_id):
     return render_template('edit_member.html', member=member)
 
 @app.route('/member/<member_id>/delete', methods=['POST'])
+@require_gym
 def delete_member(member_id):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if gym.delete_member(member_id):
+        qr_path = os.path.join(QR_FOLDER, f"{member_id}.png")
+        if os.path.exists(qr_path):
+            os.remove(qr_path)
         flash('Member deleted successfully!', 'success')
     else:
         flash('Delete failed!', 'error')
@@ -984,9 +1285,9 @@ def delete_member(member_id):
     return redirect(url_for('dashboard'))
 
 @app.route('/settings', methods=['GET', 'POST'])
+@require_gym
 def settings():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if request.method == 'POST':
         name = request.form.get('gym_name')
@@ -996,10 +1297,7 @@ def settings():
         if 'gym_logo' in request.files:
             file = request.files['gym_logo']
             if file and file.filename and allowed_file(file.filename):
-                filename = secure_filename(f"logo_{datetime.now().strftime('%Y%m%d%H%M%S')}_{file.filename}")
-                filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(filepath)
-                logo_path = filename
+                logo_path = save_content_addressed(file, 'logo_')
         
         if gym.update_gym_details(name, logo_path, currency):
             flash('Gym settings updated successfully!', 'success')
@@ -1008,16 +1306,15 @@ def settings():
         return redirect(url_for('settings'))
 
     payments = []
-    if 'logged_in' in session:
-        user = auth_manager.users.get(session['username'], {})
-        payments = user.get('payments', [])
+    if g.logged_in:
+        payments = auth_manager.get_payments(g.username)
         
     return render_template('settings.html', details=gym.get_gym_details(), payments=payments)
 
 @app.route('/restore_backup', methods=['POST'])
+@require_gym
 def restore_backup():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if 'backup_file' not in request.files:
         flash('No file selected!', 'error')
@@ -1052,71 +1349,128 @@ def restore_backup():
         
     return redirect(url_for('settings'))
 
+def receipt_logo_path(gym_details):
+    """Filesystem path of the gym logo for receipts, if one is set"""
+    if gym_details.get('logo'):
+        return os.path.join(app.config['UPLOAD_FOLDER'], gym_details['logo'])
+    return None
+
+def receipt_cache_path(member, month, fee_info, gym_details):
+    """Cache file for a receipt, keyed by everything printed on it"""
+    key = hashlib.blake2b(
+        f"{member['id']}|{member['name']}|{month}|{fee_info['paid_date']}|{fee_info['amount']}|{gym_details['name']}|{gym_details.get('logo')}".encode(),
+        digest_size=16
+    ).hexdigest()
+    return os.path.join(RECEIPT_CACHE_FOLDER, f"{key}.pdf")
+
+def prune_receipt_cache():
+    """Delete cached receipts that haven't been served for RECEIPT_CACHE_MAX_AGE"""
+    cutoff = time.time() - RECEIPT_CACHE_MAX_AGE
+    for entry in os.scandir(RECEIPT_CACHE_FOLDER):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            pass  # removed by a concurrent prune
+
 @app.route('/receipt/<member_id>/<month>')
+@require_gym
 def generate_receipt(member_id, month):
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
-    if not member or not gym.is_fee_paid(member_id, month):
+    fee_info = gym.get_fee(member_id, month) if member else None
+    if not fee_info:
         flash('Fee record not found!', 'error')
         return redirect(url_for('member_details', member_id=member_id))
     
-    # Get fee data
-    # We need to access fee details directly since get_member doesn't have it
-    # This is a bit of a hack, optimally we should have a get_fee method
-    if member_id in gym.data['fees'] and month in gym.data['fees'][member_id]:
-        fee_info = gym.data['fees'][member_id][month]
+    gym_details = gym.get_gym_details()
+    
+    # A paid receipt never changes; if any input does, the key changes with it
+    cache_path = receipt_cache_path(member, month, fee_info, gym_details)
+    if not os.path.exists(cache_path):
+        pdf = build_receipt_pdf(member_id, member['name'], month, fee_info, gym_details, receipt_logo_path(gym_details))
+        
+        # Write to a private temp file and rename, so a concurrent request
+        # never serves a half-written PDF
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=RECEIPT_CACHE_FOLDER)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(pdf)
+        os.replace(tmp_path, cache_path)
+        prune_receipt_cache()
     else:
+        # Mark as recently used so pruning keeps receipts that are still downloaded
+        os.utime(cache_path)
+    
+    return send_file(cache_path, download_name=f'receipt_{member_id}_{month}.pdf', as_attachment=True,
+                     mimetype='application/pdf', conditional=True)
+
+@app.route('/receipts/bulk')
+@require_gym
+def bulk_receipts():
+    """All of a month's receipts as one multi-page PDF"""
+    gym = g.gym
+    
+    month = request.args.get('month') or datetime.now().strftime('%Y-%m')
+    paid = gym.get_payment_status(month)['paid']
+    if not paid:
+        flash(f'No payments recorded for {month}!', 'error')
         return redirect(url_for('dashboard'))
-
-    # Create PDF
-    buffer = BytesIO()
-    c = canvas.Canvas(buffer, pagesize=letter)
-    width, height = letter
     
     gym_details = gym.get_gym_details()
+    logo_path = receipt_logo_path(gym_details)
     
-    # Header
-    c.setFont("Helvetica-Bold", 24)
-    c.drawString(50, height - 50, gym_details['name'])
+    # Render in the background when a worker is available; the page polls for the result
+    queue = get_queue()
+    if queue is not None:
+        job = queue.enqueue(build_bulk_receipts, g.username, month, logo_path, result_ttl=600)
+        return render_template('receipts_processing.html', job_id=job.id, month=month)
     
-    if gym_details.get('logo'):
-        logo_path = os.path.join(app.config['UPLOAD_FOLDER'], gym_details['logo'])
-        if os.path.exists(logo_path):
-            try:
-                img = ImageReader(logo_path)
-                c.drawImage(img, width - 100, height - 80, width=50, height=50, preserveAspectRatio=True)
-            except:
-                pass
+    pdf = build_bulk_receipts_pdf(paid, month, gym_details, logo_path)
+    return send_file(BytesIO(pdf), download_name=f'receipts_{month}.pdf', as_attachment=True,
+                     mimetype='application/pdf')
 
-    c.setFont("Helvetica-Bold", 18)
-    c.drawString(50, height - 100, "PAYMENT RECEIPT")
-    
-    c.setFont("Helvetica", 12)
-    c.drawString(50, height - 130, f"Date: {datetime.now().strftime('%Y-%m-%d')}")
-    c.drawString(50, height - 150, f"Receipt #: {member_id}-{month.replace('-', '')}")
+def fetch_receipt_job(job_id):
+    """Look up a bulk receipt job, but only for the user who started it"""
+    if redis_client is None:
+        return None
     
-    # Details
-    y = height - 200
-    c.drawString(50, y, f"Member: {member['name']} (ID: {member_id})")
-    c.drawString(50, y - 20, f"Month Paid: {month}")
-    c.drawString(50, y - 40, f"Amount Paid: ${fee_info['amount']}")
-    c.drawString(50, y - 60, f"Payment Date: {fee_info['paid_date']}")
+    from rq.job import Job
+    from rq.exceptions import NoSuchJobError
+    try:
+        job = Job.fetch(job_id, connection=redis_client)
+    except NoSuchJobError:
+        return None
     
-    # Footer
-    c.setFont("Helvetica-Oblique", 10)
-    c.drawString(50, y - 120, "Thank you for your business!")
+    if job.func_name != 'tasks.build_bulk_receipts' or job.args[0] != g.username:
+        return None
+    return job
+
+@app.route('/receipt/status/<job_id>')
+@require_gym
+def receipt_status(job_id):
+    job = fetch_receipt_job(job_id)
+    if job is None:
+        abort(404)
     
-    c.save()
-    buffer.seek(0)
+    status = job.get_status()
+    return jsonify({'status': status, 'ready': status == 'finished'})
+
+@app.route('/receipt/download/<job_id>')
+@require_gym
+def receipt_download(job_id):
+    job = fetch_receipt_job(job_id)
+    if job is None or job.get_status() != 'finished':
+        abort(404)
     
-    return send_file(buffer, download_name=f'receipt_{member_id}_{month}.pdf', as_attachment=True, mimetype='application/pdf')
+    month = job.args[1]
+    return send_file(BytesIO(job.return_value()), download_name=f'receipts_{month}.pdf', as_attachment=True,
+                     mimetype='application/pdf')
 
 @app.route('/bulk_import', methods=['GET', 'POST'])
+@require_gym
 def bulk_import():
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     if request.method == 'POST':
         if 'import_file' not in request.files:
@@ -1158,11 +1512,9 @@ def bulk_import():
     return render_template('bulk_import.html')
 
 @app.route('/download_template')
+@require_gym
 def download_template():
     """Download sample Excel template for bulk import"""
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
-    
     # Create sample data
     sample_data = {
         'Name': ['John Doe', 'Jane Smith', 'Ahmed Ali'],
@@ -1172,6 +1524,7 @@ def download_template():
         'Joined Date': ['2025-01-01', '2025-01-05', '2025-01-10']
     }
     
+    import pandas as pd
     df = pd.DataFrame(sample_data)
     
     # Create Excel file
@@ -1196,10 +1549,10 @@ def download_template():
     return send_file(output, download_name=filename, as_attachment=True)
 
 @app.route('/member/<member_id>/wallet_pass')
+@require_gym
 def generate_wallet_pass(member_id):
     """Generate Google Wallet pass for member"""
-    gym = get_gym()
-    if not gym: return redirect(url_for('auth'))
+    gym = g.gym
     
     member = gym.get_member(member_id)
     if not member:
@@ -1207,6 +1560,7 @@ def generate_wallet_pass(member_id):
         return redirect(url_for('dashboard'))
     
     # Initialize wallet pass generator
+    from google_wallet import GymWalletPass
     wallet = GymWalletPass()
     
     if not wallet.is_configured():
@@ -3,23 +3,67 @@ Database-backed Authentication Manager
 Uses PostgreSQL User table instead of JSON files
 """
 
-from models import User, get_session
-from werkzeug.security import generate_password_hash, check_password_hash
+from models import User, Subscription, SubscriptionPayment, get_session
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import check_password_hash
 from datetime import datetime, timedelta
+from functools import lru_cache
+import bcrypt
+import hashlib
+import hmac
+import os
+import re
 import secrets
 
+# bcrypt cost factor; raise over time as hardware gets faster.
+# Existing hashes are upgraded on the user's next successful login.
+BCRYPT_ROUNDS = int(os.getenv('BCRYPT_ROUNDS', '12'))
+
+# Length of the free trial for new accounts, in days. Unset means trials
+# don't expire (no paywall) until a trial length is configured.
+TRIAL_DAYS = int(os.getenv('TRIAL_DAYS')) if os.getenv('TRIAL_DAYS') else None
+# One payment (Stripe checkout or approved manual proof) buys this much time
+SUBSCRIPTION_DAYS = 30
+SUBSCRIPTION_PRICE = 60
+
+# Unsalted SHA-256 hex digests from the old users.json store
+_SHA256_HEX_RE = re.compile(r'^[0-9a-f]{64}$')
+
+# Anything that could escape gym_data/ or is unusual in an email address
+_UNSAFE_FILENAME_RE = re.compile(r'[^A-Za-z0-9@._+-]')
+
+@lru_cache(maxsize=4096)
+def user_data_file(username):
+    """Legacy gym_data/<user>.json path with the username reduced to safe characters"""
+    safe_name = _UNSAFE_FILENAME_RE.sub('', username).lstrip('.')
+    return f"gym_data/{safe_name}.json"
+
 class AuthManager:
-    def __init__(self):
-        self.session = get_session()
+    # app.py shares one instance across all request threads, so the session
+    # is looked up per call instead of being captured at construction
+    @property
+    def session(self):
+        """Database session for the current thread/request"""
+        return get_session()
     
     def hash_password(self, password):
-        """Hash password using werkzeug"""
-        return generate_password_hash(password)
+        """Hash password using bcrypt"""
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
     
     def check_password(self, password_hash, password):
-        """Verify password"""
+        """Verify password (bcrypt, or a legacy werkzeug / SHA-256 hash)"""
+        if password_hash.startswith('$2'):
+            return bcrypt.checkpw(password.encode(), password_hash.encode())
+        if _SHA256_HEX_RE.match(password_hash):
+            return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), password_hash)
         return check_password_hash(password_hash, password)
     
+    def needs_rehash(self, password_hash):
+        """True for legacy hashes and bcrypt hashes below the current cost"""
+        if not password_hash.startswith('$2'):
+            return True
+        return int(password_hash.split('$')[2]) < BCRYPT_ROUNDS
+    
     def user_exists(self, username):
         """Check if user exists"""
         user = self.session.query(User).filter_by(email=username).first()
@@ -40,6 +84,11 @@ class AuthManager:
             password_hash=self.hash_password(password),
             role='admin'
         )
+        user.subscription = Subscription(
+            plan='free_lifetime' if self.validate_referral(referral_code) else 'standard',
+            status='trial',
+            expires_at=datetime.utcnow() + timedelta(days=TRIAL_DAYS) if TRIAL_DAYS is not None else None
+        )
         
         self.session.add(user)
         self.session.commit()
@@ -51,11 +100,139 @@ class AuthManager:
         if not user:
             return False
         
-        return self.check_password(user.password_hash, password)
+        if not self.check_password(user.password_hash, password):
+            return False
+        
+        # Migrate legacy / weaker hashes now that we know the password
+        if self.needs_rehash(user.password_hash):
+            user.password_hash = self.hash_password(password)
+            self.session.commit()
+        return True
+    
+    # Subscription Methods
+    def _get_subscription(self, username, create=False):
+        """The user's Subscription row (created like the init_db backfill if asked and missing)"""
+        user = self.session.query(User).filter_by(email=username).first()
+        if not user:
+            return None
+        
+        if user.subscription is None and create:
+            user.subscription = Subscription(plan='standard', status='active')
+            self.session.flush()
+        return user.subscription
+    
+    def is_subscription_active(self, username):
+        """True unless the user's trial or paid period has an expiry date that has passed"""
+        user = self.session.query(User).filter_by(email=username).first()
+        if not user:
+            return False
+        
+        sub = user.subscription
+        # No row yet (backfilled by init_db), lifetime plans and rows without an
+        # expiry (existing accounts, trials with TRIAL_DAYS unset) stay active
+        if sub is None or sub.plan == 'free_lifetime' or sub.expires_at is None:
+            return True
+        return datetime.utcnow() < sub.expires_at
+    
+    def get_plan(self, username):
+        """The user's plan name ('standard' if unknown)"""
+        sub = self._get_subscription(username)
+        return sub.plan if sub and sub.plan else 'standard'
+    
+    def get_subscription_status(self, username):
+        """trial / active / pending, or None for unknown users"""
+        sub = self._get_subscription(username)
+        return sub.status if sub else None
+    
+    def get_payments(self, username):
+        """Billing history for the settings page, newest first"""
+        user = self.session.query(User).filter_by(email=username).first()
+        if not user:
+            return []
+        
+        payments = self.session.query(SubscriptionPayment).filter_by(user_id=user.id).order_by(
+            SubscriptionPayment.created_at.desc()
+        ).all()
+        return [
+            {
+                'date': p.created_at.strftime('%Y-%m-%d'),
+                'amount': float(p.amount),
+                'method': p.method,
+                'status': p.status
+            }
+            for p in payments
+        ]
+    
+    def renew_subscription(self, username, amount=SUBSCRIPTION_PRICE, method='stripe', reference=None):
+        """Record a payment and extend the subscription; False if unknown user or reference already used"""
+        sub = self._get_subscription(username, create=True)
+        if sub is None:
+            return False
+        
+        # Extend from the current expiry if still running, so early renewals aren't lost
+        now = datetime.utcnow()
+        start = sub.expires_at if sub.expires_at and sub.expires_at > now else now
+        sub.expires_at = start + timedelta(days=SUBSCRIPTION_DAYS)
+        sub.status = 'active'
+        sub.proof_file = None
+        self.session.add(SubscriptionPayment(
+            user_id=sub.user_id,
+            amount=amount,
+            method=method,
+            reference=reference
+        ))
+        
+        # The unique reference makes a second renewal for the same checkout fail here
+        try:
+            self.session.commit()
+        except IntegrityError:
+            self.session.rollback()
+            return False
+        return True
+    
+    def payment_recorded(self, reference):
+        """True if a payment with this reference (Stripe checkout session id) was already recorded"""
+        return self.session.query(SubscriptionPayment.id).filter_by(reference=reference).first() is not None
+    
+    def set_payment_pending(self, username, proof_filename):
+        """Attach a manual payment proof and wait for an admin"""
+        sub = self._get_subscription(username, create=True)
+        if sub is None:
+            return False
+        
+        sub.status = 'pending'
+        sub.proof_file = proof_filename
+        self.session.commit()
+        return True
+    
+    def get_pending_approvals(self):
+        """Users with a manual payment proof waiting for approval"""
+        rows = self.session.query(User, Subscription).join(Subscription).filter(
+            Subscription.status == 'pending'
+        ).order_by(Subscription.updated_at).all()
+        return [
+            {
+                'username': user.email,
+                'joined': user.created_at.strftime('%Y-%m-%d') if user.created_at else '',
+                'proof': sub.proof_file
+            }
+            for user, sub in rows
+        ]
+    
+    def approve_manual_payment(self, username):
+        """Approve a pending manual payment; False if there is nothing pending"""
+        # Lock the row so two admins approving at once can't both renew
+        sub = self.session.query(Subscription).join(User).filter(
+            User.email == username
+        ).with_for_update().first()
+        if sub is None or sub.status != 'pending':
+            self.session.rollback()
+            return False
+        return self.renew_subscription(username, method='manual')
     
     def get_user_data_file(self, username):
         """Get user's data file path (legacy - not used with PostgreSQL)"""
-        return f"gym_data/{username}.json"
+        return user_data_file(username)
     
     # Password Reset Methods
     def generate_reset_code(self, username):
@@ -86,7 +263,6 @@ class AuthManager:
         self.session.commit()
         return True
     
-    def __del__(self):
-        """Close database session"""
-        if hasattr(self, 'session'):
-            self.session.close()
+    def reset_password(self, username, new_password):
+        """Set a new password after a verified reset code"""
+        return self.update_password(username, new_password)
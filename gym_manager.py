@@ -4,43 +4,134 @@ Uses PostgreSQL via SQLAlchemy instead of JSON files
 """
 
 from models import User, Gym, Member, Fee, Attendance, Expense, get_session
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 from typing import Dict, List, Optional, Tuple
-from sqlalchemy import func, extract
+from collections import namedtuple
+from contextlib import contextmanager
+import threading
+import time
+from sqlalchemy import func
 from sqlalchemy.exc import IntegrityError
 
+# Gym details are read on every page render but almost never change; other
+# workers pick up an edit within this many seconds
+GYM_DETAILS_TTL = 30
+
+DashboardStats = namedtuple('DashboardStats', ['total', 'expiring_count', 'paid', 'unpaid', 'revenue', 'last_revenue'])
+
+class PaymentRow:
+    """One member's line in the paid/unpaid lists (fee fields are None when unpaid)"""
+    __slots__ = ('id', 'name', 'phone', 'email', 'photo', 'membership_type', 'is_trial', 'trial_end_date',
+                 'amount', 'date')
+    
+    def __init__(self, id, name, phone, email, photo, membership_type, is_trial, trial_end_date,
+                 amount=None, date=None):
+        self.id = id
+        self.name = name
+        self.phone = phone
+        self.email = email
+        self.photo = photo
+        self.membership_type = membership_type
+        self.is_trial = is_trial
+        self.trial_end_date = trial_end_date
+        self.amount = amount
+        self.date = date
+    
+    def as_dict(self) -> Dict:
+        """Plain dict for JSON output (the dashboard embeds unpaid rows with tojson)"""
+        return {name: getattr(self, name) for name in self.__slots__}
+
+def previous_month(month: str) -> str:
+    """'2025-03' -> '2025-02'"""
+    year, month_num = map(int, month.split('-'))
+    if month_num == 1:
+        return f"{year - 1:04d}-12"
+    return f"{year:04d}-{month_num - 1:02d}"
+
+def month_bounds(month: str) -> Tuple[date, date]:
+    """'2025-03' -> (2025-03-01, 2025-04-01), for half-open date range filters"""
+    year, month_num = map(int, month.split('-'))
+    start = date(year, month_num, 1)
+    end = date(year + 1, 1, 1) if month_num == 12 else date(year, month_num + 1, 1)
+    return start, end
+
 class GymManager:
     def __init__(self, user_email):
         """Initialize with user's email"""
         self.user_email = user_email
-        self.session = get_session()
+        self.gym_id = None
+        self._details = None
+        self._details_loaded_at = 0.0
+        # Instances are shared between request threads (see get_gym in app.py).
+        # Database state lives in each thread's own session; this guards the
+        # in-memory details cache.
+        self._lock = threading.RLock()
         
         # Get or create user's gym
         user = self.session.query(User).filter_by(email=user_email).first()
         if user:
-            self.gym = self.session.query(Gym).filter_by(user_id=user.id).first()
-            if not self.gym:
+            gym = self.session.query(Gym).filter_by(user_id=user.id).first()
+            if not gym:
                 # Create default gym for user
-                self.gym = Gym(
+                gym = Gym(
                     user_id=user.id,
                     name='Gym Manager',
                     currency='Rs'
                 )
-                self.session.add(self.gym)
+                self.session.add(gym)
                 self.session.commit()
-        else:
-            self.gym = None
+            self.gym_id = gym.id
+    
+    @property
+    def session(self):
+        """Database session for the current thread/request"""
+        return get_session()
+    
+    @property
+    def gym(self):
+        """This user's Gym row (served from the session identity map after the first access)"""
+        if self.gym_id is None:
+            return None
+        return self.session.get(Gym, self.gym_id)
+    
+    def _mark_dirty(self):
+        """Flush pending changes (assigns ids, surfaces constraint errors) and defer the commit"""
+        self.session.flush()
+        self.session.info['dirty'] = True
+    
+    def flush(self):
+        """Commit changes made since the last flush, if any (called once per request)"""
+        if self.session.info.pop('dirty', False):
+            self.session.commit()
+    
+    @contextmanager
+    def batch(self):
+        """Group several mutations into a single commit (for scripts)"""
+        try:
+            yield self
+        except Exception:
+            self.session.info.pop('dirty', None)
+            self.session.rollback()
+            raise
+        self.flush()
     
     def get_gym_details(self) -> Dict:
         """Get gym name, logo, and currency"""
-        if not self.gym:
-            return {'name': 'Gym Manager', 'logo': None, 'currency': 'Rs'}
-        
-        return {
-            'name': self.gym.name,
-            'logo': self.gym.logo_url,
-            'currency': self.gym.currency
-        }
+        with self._lock:
+            if self._details is None or time.monotonic() - self._details_loaded_at > GYM_DETAILS_TTL:
+                gym = self.gym
+                if not gym:
+                    return {'name': 'Gym Manager', 'logo': None, 'currency': 'Rs'}
+                
+                self._details = {
+                    'name': gym.name,
+                    'logo': gym.logo_url,
+                    'currency': gym.currency
+                }
+                self._details_loaded_at = time.monotonic()
+            
+            # Callers may modify the dict, so hand out a copy
+            return dict(self._details)
     
     def update_gym_details(self, name: str, logo_path: Optional[str] = None, currency: str = 'Rs') -> bool:
         """Update gym name, logo, and currency"""
@@ -52,7 +143,9 @@ class GymManager:
         if logo_path:
             self.gym.logo_url = logo_path
         
-        self.session.commit()
+        with self._lock:
+            self._details = None
+        self._mark_dirty()
         return True
     
     def add_member(self, name: str, phone: str, photo: str = None, membership_type: str = 'Gym', 
@@ -64,9 +157,10 @@ class GymManager:
         if not joined_date:
             joined_date = datetime.now().strftime('%Y-%m-%d')
         
+        joined = date.fromisoformat(joined_date)
         trial_end = None
         if is_trial:
-            trial_end = (datetime.strptime(joined_date, '%Y-%m-%d') + timedelta(days=3)).date()
+            trial_end = joined + timedelta(days=3)
         
         member = Member(
             gym_id=self.gym.id,
@@ -75,13 +169,13 @@ class GymManager:
             email=email or '',
             photo_url=photo,
             membership_type=membership_type,
-            joined_date=datetime.strptime(joined_date, '%Y-%m-%d').date(),
+            joined_date=joined,
             is_trial=is_trial,
             trial_end_date=trial_end
         )
         
         self.session.add(member)
-        self.session.commit()
+        self._mark_dirty()
         return member.id
     
     def update_member(self, member_id: str, name: str, phone: str, membership_type: str, 
@@ -99,9 +193,9 @@ class GymManager:
             member.email = email
         
         if joined_date:
-            member.joined_date = datetime.strptime(joined_date, '%Y-%m-%d').date()
+            member.joined_date = date.fromisoformat(joined_date)
         
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def delete_member(self, member_id: str) -> bool:
@@ -111,7 +205,7 @@ class GymManager:
             return False
         
         self.session.delete(member)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def get_member(self, member_id: str) -> Optional[Dict]:
@@ -194,11 +288,11 @@ class GymManager:
             member_id=member.id,
             month=month,
             amount=amount,
-            paid_date=datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+            paid_date=datetime.fromisoformat(date)
         )
         
         self.session.add(fee)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def update_fee(self, member_id: str, month: str, amount: float, date: str) -> bool:
@@ -212,9 +306,9 @@ class GymManager:
             return False
         
         fee.amount = amount
-        fee.paid_date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S')
+        fee.paid_date = datetime.fromisoformat(date)
         
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def delete_fee(self, member_id: str, month: str) -> bool:
@@ -228,9 +322,24 @@ class GymManager:
             return False
         
         self.session.delete(fee)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
+    def get_fee(self, member_id: str, month: str) -> Optional[Dict]:
+        """Get a single fee record for a member and month"""
+        member = self.session.query(Member).filter_by(id=int(member_id), gym_id=self.gym.id).first()
+        if not member:
+            return None
+        
+        fee = self.session.query(Fee).filter_by(member_id=member.id, month=month).first()
+        if not fee:
+            return None
+        
+        return {
+            'amount': float(fee.amount),
+            'paid_date': fee.paid_date.strftime('%Y-%m-%d %H:%M:%S')
+        }
+    
     def is_fee_paid(self, member_id: str, month: str) -> bool:
         """Check if fee is paid for a month"""
         member = self.session.query(Member).filter_by(id=int(member_id), gym_id=self.gym.id).first()
@@ -250,63 +359,133 @@ class GymManager:
         
         all_members = self.session.query(Member).filter_by(gym_id=self.gym.id, is_active=True).all()
         
+        # One query for the month's fees instead of one per member
+        fees_by_member = {
+            fee.member_id: fee
+            for fee in self.session.query(Fee).join(Member).filter(
+                Member.gym_id == self.gym.id,
+                Fee.month == month
+            )
+        }
+        
         paid = []
         unpaid = []
         
         for member in all_members:
-            fee = self.session.query(Fee).filter_by(member_id=member.id, month=month).first()
+            fee = fees_by_member.get(member.id)
             
-            member_data = {
-                'id': str(member.id),
-                'name': member.name,
-                'phone': member.phone,
-                'membership_type': member.membership_type
-            }
+            row = PaymentRow(
+                id=str(member.id),
+                name=member.name,
+                phone=member.phone,
+                email=member.email,
+                photo=member.photo_url,
+                membership_type=member.membership_type,
+                is_trial=member.is_trial,
+                trial_end_date=member.trial_end_date.strftime('%Y-%m-%d') if member.trial_end_date else None
+            )
             
             if fee:
-                member_data['amount'] = float(fee.amount)
-                member_data['date'] = fee.paid_date.strftime('%Y-%m-%d %H:%M:%S')
-                paid.append(member_data)
+                row.amount = float(fee.amount)
+                row.date = fee.paid_date.strftime('%Y-%m-%d %H:%M:%S')
+                paid.append(row)
             else:
-                unpaid.append(member_data)
+                unpaid.append(row)
         
         return {'paid': paid, 'unpaid': unpaid}
     
-    def get_member_fees(self, member_id: str) -> List[Dict]:
-        """Get all fees for a member"""
-        member = self.session.query(Member).filter_by(id=int(member_id), gym_id=self.gym.id).first()
-        if not member:
+    def dashboard_stats(self, month: str = None, today=None) -> DashboardStats:
+        """Member count, expiring trials and paid/unpaid split for a month in one go"""
+        if not month:
+            month = datetime.now().strftime('%Y-%m')
+        if today is None:
+            today = datetime.now().date()
+        
+        status = self.get_payment_status(month)
+        paid, unpaid = status['paid'], status['unpaid']
+        
+        if not self.gym:
+            return DashboardStats(0, 0, paid, unpaid, 0, 0.0)
+        
+        # Trials ending within the next 3 days, counted by the database
+        expiring_count = self.session.query(func.count(Member.id)).filter(
+            Member.gym_id == self.gym.id,
+            Member.is_active == True,
+            Member.is_trial == True,
+            Member.trial_end_date.between(today, today + timedelta(days=3))
+        ).scalar() or 0
+        
+        return DashboardStats(
+            total=len(paid) + len(unpaid),
+            expiring_count=expiring_count,
+            paid=paid,
+            unpaid=unpaid,
+            revenue=sum(row.amount for row in paid),
+            # Same population as `revenue` (active members), so the change % compares like with like
+            last_revenue=self.get_revenue(previous_month(month), active_only=True)
+        )
+    
+    def total_checkins(self) -> int:
+        """Total attendance records across all of this gym's members"""
+        if not self.gym:
+            return 0
+        
+        return self.session.query(func.count(Attendance.id)).join(Member).filter(
+            Member.gym_id == self.gym.id
+        ).scalar() or 0
+    
+    def get_member_fees(self, member_id: str, limit: int = None) -> List[Dict]:
+        """Get fees for a member, newest month first (optionally only the latest `limit`)"""
+        if not self.gym:
             return []
         
-        fees = self.session.query(Fee).filter_by(member_id=member.id).order_by(Fee.month.desc()).all()
+        query = self.session.query(Fee).join(Member).filter(
+            Fee.member_id == int(member_id),
+            Member.gym_id == self.gym.id
+        ).order_by(Fee.month.desc())
+        if limit:
+            query = query.limit(limit)
         
         return [
             {
                 'month': f.month,
                 'amount': float(f.amount),
-                'date': f.paid_date.strftime('%Y-%m-%d %H:%M:%S')
+                'paid_date': f.paid_date.strftime('%Y-%m-%d %H:%M:%S')
             }
-            for f in fees
+            for f in query.all()
         ]
     
-    def get_revenue(self, month: str = None) -> float:
-        """Get total revenue for a month"""
+    def get_revenue(self, month: str = None, active_only: bool = False) -> float:
+        """Get total revenue for a month (optionally from active members only, as the dashboard counts it)"""
         if not month:
             month = datetime.now().strftime('%Y-%m')
         
         if not self.gym:
             return 0.0
         
-        # Get all members for this gym
-        member_ids = [m.id for m in self.session.query(Member).filter_by(gym_id=self.gym.id).all()]
-        
-        total = self.session.query(func.sum(Fee.amount)).filter(
-            Fee.member_id.in_(member_ids),
+        query = self.session.query(func.sum(Fee.amount)).join(Member).filter(
+            Member.gym_id == self.gym.id,
             Fee.month == month
-        ).scalar()
+        )
+        if active_only:
+            query = query.filter(Member.is_active == True)
+        total = query.scalar()
         
         return float(total) if total else 0.0
     
+    def monthly_revenue_since(self, start_month: str) -> Dict[str, float]:
+        """Revenue per month ('YYYY-MM' -> total) from start_month onwards, in one query"""
+        if not self.gym:
+            return {}
+        
+        rows = self.session.query(Fee.month, func.sum(Fee.amount)).join(Member).filter(
+            Member.gym_id == self.gym.id,
+            Member.is_active == True,
+            Fee.month >= start_month
+        ).group_by(Fee.month).all()
+        
+        return {month: float(total) for month, total in rows}
+    
     def log_attendance(self, member_id: str, emotion: str = None, confidence: float = None) -> bool:
         """Log member attendance"""
         member = self.session.query(Member).filter_by(id=int(member_id), gym_id=self.gym.id).first()
@@ -321,16 +500,19 @@ class GymManager:
         )
         
         self.session.add(attendance)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
-    def get_attendance(self, member_id: str) -> List:
-        """Get attendance history for a member"""
+    def get_attendance(self, member_id: str, limit: int = None) -> List:
+        """Get attendance history for a member, newest first (optionally only the latest `limit`)"""
         member = self.session.query(Member).filter_by(id=int(member_id), gym_id=self.gym.id).first()
         if not member:
             return []
         
-        records = self.session.query(Attendance).filter_by(member_id=member.id).order_by(Attendance.check_in_time.desc()).all()
+        query = self.session.query(Attendance).filter_by(member_id=member.id).order_by(Attendance.check_in_time.desc())
+        if limit:
+            query = query.limit(limit)
+        records = query.all()
         
         return [
             {
@@ -341,6 +523,13 @@ class GymManager:
             for r in records
         ]
     
+    def count_attendance(self, member_id: str) -> int:
+        """Number of check-ins for a member"""
+        return self.session.query(func.count(Attendance.id)).join(Member).filter(
+            Member.id == int(member_id),
+            Member.gym_id == self.gym.id
+        ).scalar() or 0
+    
     # Expense Management
     def add_expense(self, category: str, amount: float, date: str, description: str = '') -> bool:
         """Add an expense record"""
@@ -351,12 +540,12 @@ class GymManager:
             gym_id=self.gym.id,
             category=category,
             amount=amount,
-            date=datetime.strptime(date, '%Y-%m-%d').date(),
+            date=datetime.fromisoformat(date).date(),
             description=description
         )
         
         self.session.add(expense)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def get_expenses(self, month: str = None) -> list:
@@ -367,11 +556,9 @@ class GymManager:
         query = self.session.query(Expense).filter_by(gym_id=self.gym.id)
         
         if month:
-            year, month_num = map(int, month.split('-'))
-            query = query.filter(
-                extract('year', Expense.date) == year,
-                extract('month', Expense.date) == month_num
-            )
+            # A plain range on the date column can use the (gym_id, date) index
+            start, end = month_bounds(month)
+            query = query.filter(Expense.date >= start, Expense.date < end)
         
         expenses = query.order_by(Expense.date.desc()).all()
         
@@ -386,6 +573,36 @@ class GymManager:
             for e in expenses
         ]
     
+    def get_total_expenses(self, month: str) -> float:
+        """Sum of expenses for a month"""
+        if not self.gym:
+            return 0.0
+        
+        start, end = month_bounds(month)
+        total = self.session.query(func.sum(Expense.amount)).filter(
+            Expense.gym_id == self.gym.id,
+            Expense.date >= start,
+            Expense.date < end
+        ).scalar()
+        
+        return float(total) if total else 0.0
+    
+    def calculate_profit_loss(self, month: str = None) -> Dict:
+        """Revenue, expenses and net profit for a month, summed by the database"""
+        if not month:
+            month = datetime.now().strftime('%Y-%m')
+        
+        revenue = self.get_revenue(month)
+        expenses = self.get_total_expenses(month)
+        net_profit = revenue - expenses
+        
+        return {
+            'revenue': round(revenue, 2),
+            'expenses': round(expenses, 2),
+            'net_profit': round(net_profit, 2),
+            'profit_margin': round(net_profit / revenue * 100, 1) if revenue else 0
+        }
+    
     def delete_expense(self, expense_id: str) -> bool:
         """Delete an expense"""
         expense = self.session.query(Expense).filter_by(id=expense_id, gym_id=self.gym.id).first()
@@ -393,7 +610,7 @@ class GymManager:
             return False
         
         self.session.delete(expense)
-        self.session.commit()
+        self._mark_dirty()
         return True
     
     def bulk_import_members(self, filepath: str) -> Tuple[int, int, List[str]]:
@@ -441,7 +658,7 @@ class GymManager:
                             phone=phone,
                             email=str(row.get('Email', '')).strip(),
                             membership_type=str(row.get('Membership Type', 'Gym')).strip(),
-                            joined_date=datetime.strptime(str(joined_date), '%Y-%m-%d').date()
+                            joined_date=datetime.fromisoformat(str(joined_date)).date()
                         )
                         self.session.add(member)
                         success_count += 1
@@ -450,13 +667,8 @@ class GymManager:
                     errors.append(f"Row {index + 2}: {str(e)}")
                     error_count += 1
             
-            self.session.commit()
+            self._mark_dirty()
             return success_count, error_count, errors
         
         except Exception as e:
             return 0, 0, [f"File error: {str(e)}"]
-    
-    def __del__(self):
-        """Close database session"""
-        if hasattr(self, 'session'):
-            self.session.close()
@@ -3,9 +3,10 @@ Database models for Gym Manager
 PostgreSQL schema using SQLAlchemy ORM
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Date, ForeignKey, Text, DECIMAL
+from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Date, ForeignKey, Text, DECIMAL, Index
+from sqlalchemy import select, insert, exists, literal, func
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
+from sqlalchemy.orm import relationship, sessionmaker, scoped_session
 from datetime import datetime
 import os
 
@@ -22,6 +23,37 @@ class User(Base):
     
     # Relationships
     gyms = relationship('Gym', back_populates='user', cascade='all, delete-orphan')
+    subscription = relationship('Subscription', back_populates='user', uselist=False, cascade='all, delete-orphan')
+    subscription_payments = relationship('SubscriptionPayment', back_populates='user', cascade='all, delete-orphan')
+
+class Subscription(Base):
+    __tablename__ = 'subscriptions'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), unique=True, nullable=False)
+    plan = Column(String(50), default='standard')  # standard / free_lifetime
+    status = Column(String(20), default='trial')  # trial / active / pending
+    expires_at = Column(DateTime)
+    proof_file = Column(String(500))  # manual payment proof awaiting approval
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # Relationships
+    user = relationship('User', back_populates='subscription')
+
+class SubscriptionPayment(Base):
+    __tablename__ = 'subscription_payments'
+    
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    amount = Column(DECIMAL(10, 2), nullable=False)
+    method = Column(String(50), nullable=False)  # stripe / manual
+    status = Column(String(20), default='paid')
+    # Stripe checkout session id; unique so a session can only renew once
+    reference = Column(String(255), unique=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Relationships
+    user = relationship('User', back_populates='subscription_payments')
 
 class Gym(Base):
     __tablename__ = 'gyms'
@@ -61,6 +93,9 @@ class Member(Base):
 
 class Fee(Base):
     __tablename__ = 'fees'
+    # Fee lookups are always by member and month; the index also returns a
+    # member's history already sorted by month
+    __table_args__ = (Index('ix_fees_member_month', 'member_id', 'month'),)
     
     id = Column(Integer, primary_key=True)
     member_id = Column(Integer, ForeignKey('members.id'), nullable=False)
@@ -87,6 +122,13 @@ class Attendance(Base):
 
 class Expense(Base):
     __tablename__ = 'expenses'
+    __table_args__ = (
+        # Monthly expense lists and totals filter on a date range per gym
+        Index('ix_expenses_gym_date', 'gym_id', 'date'),
+        # Never hand out a deleted expense's id again on SQLite, so a stale
+        # delete link can't remove a newer expense (Postgres sequences already don't)
+        {'sqlite_autoincrement': True}
+    )
     
     id = Column(Integer, primary_key=True)
     gym_id = Column(Integer, ForeignKey('gyms.id'), nullable=False)
@@ -113,14 +155,46 @@ def get_database_url():
         # Local development - use SQLite
         return 'sqlite:///gym_manager.db'
 
+_engine = None
+_session_registry = None
+
+def get_engine():
+    """Get the process-wide engine (one connection pool per worker)"""
+    global _engine
+    if _engine is None:
+        _engine = create_engine(get_database_url())
+    return _engine
+
+# Indexes added after the first release. create_all only creates indexes
+# together with a new table, so existing databases get them here.
+LATE_INDEXED_TABLES = (Fee.__table__, Expense.__table__)
+
+def backfill_subscriptions(engine):
+    """Give accounts created before subscriptions existed an active subscription with no expiry"""
+    without_subscription = select(User.id, literal('standard'), literal('active'), func.now()).where(
+        ~exists().where(Subscription.user_id == User.id)
+    )
+    with engine.begin() as conn:
+        conn.execute(insert(Subscription).from_select(['user_id', 'plan', 'status', 'updated_at'], without_subscription))
+
 def init_db():
     """Initialize database and create all tables"""
-    engine = create_engine(get_database_url())
+    engine = get_engine()
     Base.metadata.create_all(engine)
+    for table in LATE_INDEXED_TABLES:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    backfill_subscriptions(engine)
     return engine
 
 def get_session():
-    """Get database session"""
-    engine = create_engine(get_database_url())
-    Session = sessionmaker(bind=engine)
-    return Session()
+    """Get database session for the current thread"""
+    global _session_registry
+    if _session_registry is None:
+        _session_registry = scoped_session(sessionmaker(bind=get_engine()))
+    return _session_registry()
+
+def remove_session():
+    """Close the current thread's session (called at request teardown)"""
+    if _session_registry is not None:
+        _session_registry.remove()
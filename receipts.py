@@ -0,0 +1,77 @@
+"""
+PDF receipts for Gym Manager
+Shared by the web app and the background worker (no Flask imports here)
+"""
+
+import os
+from io import BytesIO
+from functools import lru_cache
+
+# Strips the dash from 'YYYY-MM' for receipt numbers
+_DASH_TBL = str.maketrans('', '', '-')
+
+@lru_cache(maxsize=8)
+def get_logo_reader(path, mtime_ns):
+    """Decoded logo image, reused until the file changes (mtime is part of the key)"""
+    from reportlab.lib.utils import ImageReader
+    return ImageReader(path)
+
+def draw_receipt_page(c, member_id, member_name, month, amount, paid_date, gym_details, logo_path=None):
+    """Draw one receipt onto the current page of a ReportLab canvas"""
+    from reportlab.lib.pagesizes import letter
+    width, height = letter
+
+    # Header
+    c.setFont("Helvetica-Bold", 24)
+    c.drawString(50, height - 50, gym_details['name'])
+
+    if logo_path and os.path.exists(logo_path):
+        try:
+            img = get_logo_reader(logo_path, os.stat(logo_path).st_mtime_ns)
+            c.drawImage(img, width - 100, height - 80, width=50, height=50, preserveAspectRatio=True)
+        except:
+            pass
+
+    c.setFont("Helvetica-Bold", 18)
+    c.drawString(50, height - 100, "PAYMENT RECEIPT")
+
+    c.setFont("Helvetica", 12)
+    # Dated by the payment, not by when the PDF was rendered, so cached copies stay correct
+    c.drawString(50, height - 130, f"Date: {str(paid_date)[:10]}")
+    c.drawString(50, height - 150, f"Receipt #: {member_id}-{month.translate(_DASH_TBL)}")
+
+    # Details
+    y = height - 200
+    c.drawString(50, y, f"Member: {member_name} (ID: {member_id})")
+    c.drawString(50, y - 20, f"Month Paid: {month}")
+    c.drawString(50, y - 40, f"Amount Paid: ${amount}")
+    c.drawString(50, y - 60, f"Payment Date: {paid_date}")
+
+    # Footer
+    c.setFont("Helvetica-Oblique", 10)
+    c.drawString(50, y - 120, "Thank you for your business!")
+
+def build_receipt_pdf(member_id, member_name, month, fee_info, gym_details, logo_path=None) -> bytes:
+    """Render a single receipt to PDF bytes"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    draw_receipt_page(c, member_id, member_name, month, fee_info['amount'], fee_info['paid_date'], gym_details, logo_path)
+    c.save()
+    return buffer.getvalue()
+
+def build_bulk_receipts_pdf(paid_rows, month, gym_details, logo_path=None) -> bytes:
+    """Render receipts for all paid rows of a month into one multi-page PDF"""
+    from reportlab.lib.pagesizes import letter
+    from reportlab.pdfgen import canvas
+
+    # One canvas for every receipt: fonts and the logo are set up once
+    buffer = BytesIO()
+    c = canvas.Canvas(buffer, pagesize=letter)
+    for row in paid_rows:
+        draw_receipt_page(c, row.id, row.name, month, row.amount, row.date, gym_details, logo_path)
+        c.showPage()
+    c.save()
+    return buffer.getvalue()
@@ -0,0 +1,20 @@
+"""
+Redis connection helper
+Shared connection for the session store and caches
+"""
+
+import os
+import redis
+
+_client = None
+
+def get_redis():
+    """Get the shared Redis client, or None when REDIS_URL is not set"""
+    global _client
+    url = os.getenv('REDIS_URL')
+    if not url:
+        return None
+    
+    if _client is None:
+        _client = redis.Redis.from_url(url)
+    return _client
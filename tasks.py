@@ -0,0 +1,81 @@
+"""
+Background jobs for Gym Manager
+Run a worker with: rq worker --url $REDIS_URL
+"""
+
+import os
+from dotenv import load_dotenv
+from rq import Queue
+from redis_utils import get_redis
+
+# Workers started with `rq worker` don't go through app.py, so read .env here
+# too (STRIPE_SECRET_KEY, DATABASE_URL, RQ_ENABLED)
+load_dotenv()
+
+_stripe = None
+
+def get_stripe():
+    """Import and configure the stripe module on first use"""
+    global _stripe
+    if _stripe is None:
+        import stripe
+        stripe.api_key = os.getenv('STRIPE_SECRET_KEY', '')
+        # Never let a slow Stripe call pin a worker for long
+        stripe.default_http_client = stripe.http_client.RequestsClient(timeout=5)
+        _stripe = stripe
+    return _stripe
+
+# Jobs are only queued when a worker is known to be running (Procfile's worker
+# entry); REDIS_URL alone is also used for sessions and caching
+RQ_ENABLED = os.getenv('RQ_ENABLED', '').lower() in ('1', 'true', 'yes')
+
+def get_queue():
+    """Get the default RQ queue, or None when background jobs are disabled"""
+    if not RQ_ENABLED:
+        return None
+    connection = get_redis()
+    if connection is None:
+        return None
+    return Queue(connection=connection)
+
+def verify_and_renew(username, session_id):
+    """Verify a Stripe Checkout Session and renew the user's subscription if it was paid"""
+    from auth_manager import AuthManager
+    from models import remove_session
+    
+    auth = AuthManager()
+    try:
+        # Already renewed for this checkout (page refresh, retried job)
+        if auth.payment_recorded(session_id):
+            return True
+        
+        checkout_session = get_stripe().checkout.Session.retrieve(session_id)
+        if checkout_session.payment_status != 'paid' or checkout_session.client_reference_id != username:
+            return False
+        
+        amount = (checkout_session.amount_total or 0) / 100
+        renewed = auth.renew_subscription(username, amount=amount, method='stripe', reference=session_id)
+        # Losing the race to a concurrent renewal for the same checkout still counts
+        if not renewed and not auth.payment_recorded(session_id):
+            return False
+    finally:
+        remove_session()
+    
+    # Drop the cached subscription status so the next request sees the renewal
+    r = get_redis()
+    if r is not None:
+        r.delete(f"sub:{username}", f"plan:{username}")
+    return True
+
+def build_bulk_receipts(username, month, logo_path=None):
+    """Render every paid receipt for a month into one PDF (the bytes are kept as the job result)"""
+    from gym_manager import GymManager
+    from models import remove_session
+    from receipts import build_bulk_receipts_pdf
+    
+    try:
+        gym = GymManager(username)
+        paid = gym.get_payment_status(month)['paid']
+        return build_bulk_receipts_pdf(paid, month, gym.get_gym_details(), logo_path)
+    finally:
+        remove_session()